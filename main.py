@@ -1,13 +1,41 @@
 import abc
-import json
+import codecs
+import concurrent.futures
+import os
+import re
+import sys
 import typing
+import zlib
 # import logging
 
 import typing_extensions
 import requests
+import lxml.etree
 import lxml.html
+import orjson
+import redis
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 DEFAULT_TIMEOUT = 60
+MAX_WORKERS = 32  # pages are fetched concurrently, the work is I/O-bound
+CACHE_TTL = 60 * 60  # parsed flats are cached in redis for an hour, the listing changes slowly
+CACHE_COMPRESS_THRESHOLD = 1024  # bytes
+CACHE_KEY_PREFIX = 'flat:v1:'  # bump the version whenever Flat fields change
+
+# xpath expressions are compiled once instead of on every parsed page
+_XP_CARDS = lxml.etree.XPath('.//a[@class="product-card"]/@href')
+_XP_BREAD = lxml.etree.XPath('.//span[@class="breadcrumbs__item"]/text()')
+_XP_RESERVED = lxml.etree.XPath('.//span[@class="badge badge--secondary"]')
+_XP_SPEC = lxml.etree.XPath('.//dl[@class="spec mb-30"]/dd/span/text()')
+_XP_PRICE = lxml.etree.XPath('.//div[@class="m-passport-price-bar__price"]/text()')
+
+_NON_DIGITS = re.compile(r'\D+')
+_COMMA_TO_DOT = str.maketrans(',', '.')
+# the first comment holds the flat id on site, script and style bodies are skipped
+# since libxml2 does not parse comments inside them
+_CHARSET = re.compile(r'charset=["\']?([\w.:-]+)', re.I)
+_COMMENT_OR_RAW_TEXT = re.compile(rb'<(script|style)\b.*?</\1\s*>|<!--(.*?)-->', re.S | re.I)
 
 
 # logging.basicConfig(
@@ -53,9 +81,77 @@ class ResponseSchema(typing_extensions.TypedDict, total=False):
     comment: typing.Optional[str]
 
 
+class Flat(typing.NamedTuple):
+    """
+    parsed flat, a tuple is lighter than a dict per record,
+    it is turned into ResponseSchema only on output
+    """
+    complex: str
+    type: str
+    building: typing.Optional[str]
+    section: typing.Optional[str]
+    floor: typing.Optional[int]
+    number: typing.Optional[str]
+    rooms: typing.Optional[typing.Union[int, str]]  # int or 'studio' str
+    area: typing.Optional[float]
+    living_area: typing.Optional[float]
+    phase: typing.Optional[str]
+    plan: typing.Optional[str]
+    price_base: typing.Optional[float]
+    sale_status: typing.Optional[str]
+    in_sale: typing.Optional[int]
+    finished: typing.Optional[typing.Union[int, str]]
+
+    def as_response(self) -> ResponseSchema:
+        return ResponseSchema(**self._asdict())
+
+
+def _get_header_encoding(response: requests.Response) -> typing.Optional[str]:
+    """
+    charset of the Content-Type header if the server sent one,
+    requests' own ISO-8859-1 fallback for text/* is not taken into account
+    :return:
+    """
+    charset = _CHARSET.search(response.headers.get('Content-Type', ''))
+    if charset is None:
+        return None
+    try:
+        return codecs.lookup(charset.group(1)).name
+    except LookupError:
+        return None
+
+
+def _html_fromstring(page_bytes: bytes, encoding: typing.Optional[str] = None) -> lxml.html.HtmlElement:
+    # the header charset wins over the page declaration, as with response.text,
+    # without it libxml2 detects the declared encoding itself; parsers are not shared between threads
+    parser = lxml.html.HTMLParser(encoding=encoding) if encoding else None
+    return lxml.html.fromstring(page_bytes, parser=parser)
+
+
+def _find_number_on_site(page_bytes: bytes) -> typing.Optional[str]:
+    for match in _COMMENT_OR_RAW_TEXT.finditer(page_bytes):
+        comment = match.group(2)
+        if comment is not None:
+            return _NON_DIGITS.sub('', comment.decode('ascii', 'ignore'))
+    return None
+
+
 class DomodedovoGradABC(abc.ABC):
     def __init__(self):
         self.session = requests.Session()
+        retry = Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=(500, 502, 503, 504),
+            raise_on_status=False  # the last response is returned, callers check status_code
+        )
+        # every request goes to the same host, so one pool large enough for all workers is kept alive,
+        # flat pages and plan images are fetched by two pools of workers sharing this session
+        self.session.mount(
+            'https://',
+            HTTPAdapter(max_retries=retry, pool_connections=1, pool_maxsize=2 * MAX_WORKERS, pool_block=False)
+        )
+        self.session.headers.update({'Connection': 'keep-alive', 'Accept-Encoding': 'gzip, deflate'})
 
     @abc.abstractmethod
     def collect(self, *args):
@@ -68,45 +164,41 @@ class DomodedovoGradUrlsParser(DomodedovoGradABC):
         self.base_url = 'https://www.domodedovograd.ru/domodedovo?grp=242602&page='  # grp query param is hardcoded
 
     @staticmethod
-    def __parse_flats_urls_on_page(page_source: str) -> typing.List[str]:
-        tree = lxml.html.fromstring(page_source)
-        cards = tree.xpath('.//a[@class="product-card"]/@href')
+    def __parse_flats_urls_on_page(page_source: bytes, encoding: typing.Optional[str] = None) -> typing.List[str]:
+        tree = _html_fromstring(page_source, encoding)
+        cards = _XP_CARDS(tree)
         return cards
 
     def __get_flats_amount(self) -> int:
-        retries = 3
-        while retries:
-            retries -= 1
-            try:
-                smart_filter_form = self.session.get(
-                    'https://www.domodedovograd.ru/ajax/GetSmartFilterForm.json?grp=242602&grp=242602&page=1',
-                    timeout=DEFAULT_TIMEOUT
-                )
-            except requests.Timeout:
-                continue
-
-            if smart_filter_form.status_code != 200:
-                return 0
-
-            text = smart_filter_form.text
-            try:
-                json_obj = json.loads(text)
-            except json.JSONDecodeError as e:
-                # print(e)  # raise some error
-                return 0
-            else:
-                return json_obj['prodCount']
+        try:
+            smart_filter_form = self.session.get(
+                'https://www.domodedovograd.ru/ajax/GetSmartFilterForm.json?grp=242602&grp=242602&page=1',
+                timeout=DEFAULT_TIMEOUT
+            )
+        except requests.RequestException:
+            return 0
 
-    def __get_count_per_page(self) -> int:
-        first_page_url = self.base_url + '1'
-        response = self.session.get(first_page_url, timeout=DEFAULT_TIMEOUT)
+        if smart_filter_form.status_code != 200:
+            return 0
 
-        if response.status_code != 200:
+        try:
+            json_obj = orjson.loads(smart_filter_form.content)
+        except orjson.JSONDecodeError as e:
+            # print(e)  # raise some error
             return 0
+        else:
+            return json_obj['prodCount']
 
-        text = response.text
-        flats_count_on_first_page = len(self.__parse_flats_urls_on_page(text))
-        return flats_count_on_first_page
+    def __bootstrap(self) -> typing.Tuple[int, typing.List[str]]:
+        """
+        requests flats amount and the first listing page at the same time,
+        the first page gives flats count per page and its urls are a part of the result
+        :return: flats amount and flats urls of the first page
+        """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            flats_amount = executor.submit(self.__get_flats_amount)
+            first_page_flats_urls = executor.submit(self.__get_flats_urls_on_page, self.base_url + '1')
+            return flats_amount.result(), first_page_flats_urls.result()
 
     @staticmethod
     def _calculate_paging(flats_amount: int, flats_per_page: int) -> int:
@@ -121,25 +213,32 @@ class DomodedovoGradUrlsParser(DomodedovoGradABC):
             return flats_amount // flats_per_page
         return (flats_amount // flats_per_page) + 1
 
-    def get_flats_urls(self, pages_urls: typing.List[str]):
-        result = []
-        for page_url in pages_urls:
-            retries = 3
-            while retries:
-                retries -= 1
-                response = self.session.get(page_url, timeout=DEFAULT_TIMEOUT)
-                if response.status_code == 200:
-                    flats_urls = self.__parse_flats_urls_on_page(response.text)
-                    result.extend(flats_urls)
-        return set(result)
+    def __get_flats_urls_on_page(self, page_url: str) -> typing.List[str]:
+        try:
+            response = self.session.get(page_url, timeout=DEFAULT_TIMEOUT)
+        except requests.RequestException as e:
+            # logging.error(e)  # a missing page is caught by the flats amount check in collect
+            return []
+        if response.status_code != 200:
+            return []
+        return self.__parse_flats_urls_on_page(response.content, _get_header_encoding(response))
+
+    def get_flats_urls(self, pages_urls: typing.Iterable[str]) -> typing.Set[str]:
+        result: typing.Set[str] = set()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            for flats_urls in executor.map(self.__get_flats_urls_on_page, pages_urls):
+                result.update(flats_urls)
+        return result
 
     def collect(self) -> typing.Set[str]:
-        flats_amount = self.__get_flats_amount()
-        flats_per_page = self.__get_count_per_page()
+        flats_amount, first_page_flats_urls = self.__bootstrap()
+        flats_per_page = len(first_page_flats_urls)
         total = self._calculate_paging(flats_amount, flats_per_page)
         # logging.info(f'Total pages count {total}: flats amount - {flats_amount}, flats per page - {flats_per_page}')
-        pages_urls = [self.base_url + str(page_num) for page_num in range(1, total + 1)]
+        page_url_template = self.base_url + '{}'
+        pages_urls = map(page_url_template.format, range(2, total + 1))  # first page is fetched
         res = self.get_flats_urls(pages_urls)
+        res.update(first_page_flats_urls)
 
         if len(res) != flats_amount:
             return set()  # or raise some error
@@ -150,46 +249,86 @@ class DomodedovoGradFlatsParser(DomodedovoGradABC):
     def __init__(self):
         super().__init__()
         self.url_adapter = 'https://www.domodedovograd.ru/'
+        self.cache = redis.Redis.from_url(
+            os.environ.get('REDIS_URL', 'redis://localhost:6379/0'),
+            socket_connect_timeout=1,
+            socket_timeout=1
+        )
 
     def get_plan_images(self, url) -> typing.Optional[typing.List[dict]]:
         response = self.session.get(url, timeout=DEFAULT_TIMEOUT)
         if response.status_code == 200:
-            return response.json()
+            return orjson.loads(response.content)
+
+    def _get_plan(
+        self,
+        number_on_site: typing.Optional[str],
+        plan_images: typing.Optional[concurrent.futures.Future]
+    ) -> typing.Optional[str]:
+        """
+        waits for plan images requested in advance or requests them right away,
+        a failed plan request gives no plan instead of losing the whole flat
+        :return:
+        """
+        if number_on_site is None:
+            return None
+
+        try:
+            if plan_images is not None:
+                plan_images = plan_images.result()
+            else:
+                plan_images = self.get_plan_images(self.__plan_data_url(number_on_site))
+        except (requests.RequestException, orjson.JSONDecodeError) as e:
+            # logging.error(e)
+            return None
+
+        if plan_images:
+            plan = str(plan_images[0].get("sm"))
+            return self.url_adapter + plan.strip('/')
+        return None
 
-    def parse_flat_page(self, page_text: str) -> ResponseSchema:
+    def __plan_data_url(self, number_on_site: str) -> str:
+        plan_data_url = '/flat-images.json?flatId=' + number_on_site
+        return self.url_adapter + plan_data_url.strip('/')
+
+    def parse_flat_page(
+        self,
+        page_bytes: bytes,
+        encoding: typing.Optional[str] = None,
+        plan_executor: typing.Optional[concurrent.futures.Executor] = None
+    ) -> Flat:
         complex_ = "Домодедово парк(Московская область, г.Домодедово, с.Домодедово, ул.Творчества)"
         type_ = 'flat'
 
-        tree = lxml.html.fromstring(page_text)
-        flat_type = tree.xpath('.//span[@class="breadcrumbs__item"]/text()')[0]
-        is_reserved = tree.xpath('.//span[@class="badge badge--secondary"]')
+        # the flat id is taken from raw bytes, so plan images are requested before the page is parsed
+        number_on_site = _find_number_on_site(page_bytes)
+        if number_on_site is not None and plan_executor is not None:
+            plan_images = plan_executor.submit(self.get_plan_images, self.__plan_data_url(number_on_site))
+        else:
+            plan_images = None
+
+        tree = _html_fromstring(page_bytes, encoding)
+        flat_type = _XP_BREAD(tree)[0]
+        is_reserved = _XP_RESERVED(tree)
 
-        params_dl = tree.xpath('.//dl[@class="spec mb-30"]/dd/span/text()')
+        params_dl = _XP_SPEC(tree)
         building = params_dl[0]
         section = params_dl[1]
         floor = params_dl[2]
         number = params_dl[3]
-        rooms = int(params_dl[4]) if 'Студия' not in flat_type else 'studio'
-        area = living_area = float(str(params_dl[5]).replace(',', '.'))
+        is_studio = 'Студия' in flat_type
+        rooms = 'studio' if is_studio else int(params_dl[4])
+        area = living_area = float(params_dl[5].translate(_COMMA_TO_DOT))
         phase = params_dl[6]
         sale_status = 'Забронировано' if is_reserved else None
         in_sale = 1
 
-        price_base = str(tree.xpath('.//div[@class="m-passport-price-bar__price"]/text()')[0])
-        price_base = float(''.join([char for char in price_base if char.isdigit()]))
-
-        number_on_site = str(tree.xpath('//comment()')[0])
-        number_on_site = ''.join([char for char in number_on_site if char.isdigit()])
+        price_base = _XP_PRICE(tree)[0]
+        price_base = float(_NON_DIGITS.sub('', price_base) or '0')
 
-        plan_data_url = '/flat-images.json?flatId=' + number_on_site
-        plan_images = self.get_plan_images(self.url_adapter + plan_data_url.strip('/'))
-        if plan_images:
-            plan = str(plan_images[0].get("sm"))
-            plan = self.url_adapter + plan.strip('/')
-        else:
-            plan = None
+        plan = self._get_plan(number_on_site, plan_images)
 
-        return ResponseSchema(
+        return Flat(
             complex=complex_,
             type=type_,
             building=building,
@@ -207,31 +346,90 @@ class DomodedovoGradFlatsParser(DomodedovoGradABC):
             finished=0
         )
 
-    def get_flat_page(self, flat_url: str) -> str:
-        retries = 3
-        while retries:
-            retries -= 1
-            try:
-                response = self.session.get(self.url_adapter + flat_url, timeout=DEFAULT_TIMEOUT)
-            except requests.Timeout:
-                pass
-            else:
-                if response.status_code == 200:
-                    return response.text
-
-    def collect(self, flats_urls: typing.Set[str]) -> str:
-        result: typing.List[ResponseSchema] = []
+    def get_flat_page(self, flat_url: str) -> typing.Optional[typing.Tuple[bytes, typing.Optional[str]]]:
+        """
+        :return: page bytes and the encoding given in the response headers
+        """
+        response = self.session.get(self.url_adapter + flat_url, timeout=DEFAULT_TIMEOUT)
+        if response.status_code == 200:
+            return response.content, _get_header_encoding(response)
+
+    def _get_cached_flat(self, flat_url: str) -> typing.Optional[Flat]:
+        try:
+            cached = self.cache.get(CACHE_KEY_PREFIX + flat_url)
+        except redis.RedisError as e:
+            # logging.warning(e)  # works without cache
+            return None
+
+        if cached is None:
+            return None
+        try:
+            if not cached.startswith(b'{'):  # payload is compressed
+                cached = zlib.decompress(cached)
+            return Flat(**orjson.loads(cached))
+        except (zlib.error, orjson.JSONDecodeError, TypeError) as e:
+            # logging.warning(e)  # stale or foreign entry, treated as a miss
+            return None
+
+    def _cache_flat(self, flat_url: str, flat: Flat):
+        payload = orjson.dumps(flat.as_response())
+        if len(payload) > CACHE_COMPRESS_THRESHOLD:
+            payload = zlib.compress(payload)
+        try:
+            self.cache.setex(CACHE_KEY_PREFIX + flat_url, CACHE_TTL, payload)
+        except redis.RedisError as e:
+            # logging.warning(e)
+            pass
+
+    def _fetch_and_parse(
+        self,
+        flat_url: str,
+        plan_executor: typing.Optional[concurrent.futures.Executor] = None
+    ) -> typing.Optional[Flat]:
+        cached = self._get_cached_flat(flat_url)
+        if cached is not None:
+            return cached
+
+        try:
+            flat_page = self.get_flat_page(flat_url)
+        except requests.RequestException as e:
+            # logging.error(e)
+            return None
+        if flat_page is None:
+            return None
+
+        page_bytes, encoding = flat_page
+        try:
+            flat = self.parse_flat_page(page_bytes, encoding, plan_executor)
+        except (lxml.etree.LxmlError, IndexError, ValueError) as e:
+            # logging.error(e)  # empty body or unexpected page layout, the flat is skipped
+            return None
+        self._cache_flat(flat_url, flat)
+        return flat
+
+    def iter_collect(self, flats_urls: typing.Set[str]) -> typing.Iterator[Flat]:
+        """
+        yields flats as soon as they are parsed, so the whole result is never kept in memory
+        :return:
+        """
         # logging.info(f'Started parsing of {len(flats_urls)} urls count')
-        for flat_url in flats_urls:
-            try:
-                page_text = self.get_flat_page(flat_url)
-            except Exception as e:
-                # logging.error(e)
-                pass
-            else:
-                result.append(self.parse_flat_page(page_text))
+        # plan images have a separate pool, flat page workers wait for them and must not block each other
+        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as plan_executor, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            # no list of futures is kept, as_completed drops every future (and its flat) once it is yielded
+            futures = (
+                executor.submit(self._fetch_and_parse, flat_url, plan_executor) for flat_url in flats_urls
+            )
+            for future in concurrent.futures.as_completed(futures):
+                flat = future.result()
+                if flat is not None:
+                    yield flat
         # logging.info(f'Parsing of {len(flats_urls)} urls is over')
-        return json.dumps(result, ensure_ascii=False)
+
+    def collect(self, flats_urls: typing.Set[str]) -> str:
+        result = [flat.as_response() for flat in self.iter_collect(flats_urls)]
+        # orjson writes non-ASCII as is
+        return orjson.dumps(result).decode()
 
 
 def main():
@@ -239,9 +437,15 @@ def main():
     flats_parser = DomodedovoGradFlatsParser()
     flats_urls = flats_urls_parser.collect()
     # flats_urls = {'/domodedovo/corpus-8/section-2/floor-2/flat-101',}
-    flats_info_json = flats_parser.collect(flats_urls)
-    print(flats_info_json)  # sys.stdout by default
-    return flats_info_json
+    # json array is written flat by flat instead of building the whole output string
+    sys.stdout.write('[')
+    try:
+        for i, flat in enumerate(flats_parser.iter_collect(flats_urls)):
+            if i:
+                sys.stdout.write(',')
+            sys.stdout.write(orjson.dumps(flat.as_response()).decode())
+    finally:
+        sys.stdout.write(']\n')  # stdout never holds unterminated json
 
 
 if __name__ == '__main__':
@@ -0,0 +1,47 @@
+import unittest
+import zlib
+
+import main
+
+
+class _StubCache:
+    def __init__(self, payload):
+        self.payload = payload
+
+    def get(self, key):
+        return self.payload
+
+
+class GetCachedFlatTestCase(unittest.TestCase):
+    def setUp(self):
+        self.parser = main.DomodedovoGradFlatsParser()
+
+    def test_bad_payloads_are_misses(self):
+        payloads = {
+            'non json': b'{not json',
+            'json list': b'[1, 2, 3]',
+            'missing fields': b'{"complex": "x", "type": "flat"}',
+            'bad zlib': b'x\x9cnot zlib data',
+            'compressed list': zlib.compress(b'[1, 2, 3]'),
+        }
+        for name, payload in payloads.items():
+            with self.subTest(name):
+                self.parser.cache = _StubCache(payload)
+                self.assertIsNone(self.parser._get_cached_flat('/domodedovo/flat-1'))
+
+    def test_cached_flat_round_trip(self):
+        flat = main.Flat(
+            'complex', 'flat', '8', '2', '2', '101', 'studio', 24.1, 24.1, '1', None, 3210000.0, None, 1, 0
+        )
+        stored = {}
+        self.parser.cache = _StubCache(None)
+        self.parser.cache.setex = lambda key, ttl, value: stored.update({key: value})
+
+        self.parser._cache_flat('/domodedovo/flat-1', flat)
+        self.parser.cache.payload = stored[main.CACHE_KEY_PREFIX + '/domodedovo/flat-1']
+
+        self.assertEqual(self.parser._get_cached_flat('/domodedovo/flat-1'), flat)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import concurrent.futures
+import pathlib
+import unittest
+
+import requests
+
+import main
+
+FIXTURES = pathlib.Path(__file__).parent / 'fixtures'
+
+
+class ParseFlatPageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.parser = main.DomodedovoGradFlatsParser()
+        self.requested_urls = []
+
+        def get_plan_images(url):
+            self.requested_urls.append(url)
+            return [{'sm': '/upload/plan.png'}]
+
+        self.parser.get_plan_images = get_plan_images
+
+    def test_comment_inside_script_is_not_flat_id(self):
+        page_bytes = (FIXTURES / 'flat_page_script_comment.html').read_bytes()
+        flat = self.parser.parse_flat_page(page_bytes)
+
+        self.assertEqual(self.requested_urls, ['https://www.domodedovograd.ru/flat-images.json?flatId=12345'])
+        self.assertEqual(flat.plan, 'https://www.domodedovograd.ru/upload/plan.png')
+        self.assertEqual(flat.number, '101')
+        self.assertEqual(flat.area, 35.4)
+        self.assertEqual(flat.price_base, 5432100.0)
+
+    def test_failed_plan_request_gives_no_plan(self):
+        def get_plan_images(url):
+            raise requests.ConnectionError(url)
+
+        self.parser.get_plan_images = get_plan_images
+        page_bytes = (FIXTURES / 'flat_page_script_comment.html').read_bytes()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as plan_executor:
+            flat = self.parser.parse_flat_page(page_bytes, plan_executor=plan_executor)
+
+        self.assertIsNone(flat.plan)
+        self.assertEqual(flat.number, '101')
+
+    def test_badge_inside_spec_list(self):
+        page_bytes = (FIXTURES / 'flat_page_badge_in_spec.html').read_bytes()
+        flat = self.parser.parse_flat_page(page_bytes)
+
+        self.assertEqual(flat.sale_status, 'Забронировано')
+        self.assertEqual(flat.building, '8')
+        self.assertEqual(flat.phase, '1')
+        self.assertEqual(flat.area, 35.4)
+
+    def test_header_encoding_is_used_without_meta_charset(self):
+        response = requests.Response()
+        response.headers['Content-Type'] = 'text/html; charset=UTF-8'
+        encoding = main._get_header_encoding(response)
+        page_bytes = (FIXTURES / 'flat_page_no_meta_charset.html').read_bytes()
+        flat = self.parser.parse_flat_page(page_bytes, encoding)
+
+        self.assertEqual(encoding, 'utf-8')
+        self.assertEqual(flat.rooms, 'studio')
+        self.assertEqual(flat.phase, 'Первая')
+
+    def test_no_header_encoding_without_charset(self):
+        response = requests.Response()
+        response.headers['Content-Type'] = 'text/html'
+
+        self.assertIsNone(main._get_header_encoding(response))
+
+
+
+class _NoCache:
+    def get(self, key):
+        return None
+
+    def setex(self, key, ttl, value):
+        ...
+
+
+class FetchAndParseTestCase(unittest.TestCase):
+    def setUp(self):
+        self.parser = main.DomodedovoGradFlatsParser()
+        self.parser.cache = _NoCache()
+
+    def test_broken_pages_are_skipped(self):
+        pages = [b'', b'<html><body><p>no spec list</p></body></html>']
+        for page_bytes in pages:
+            with self.subTest(page_bytes=page_bytes):
+                self.parser.get_flat_page = lambda flat_url: (page_bytes, None)
+                self.assertIsNone(self.parser._fetch_and_parse('/domodedovo/flat-1'))
+
+    def test_iter_collect_skips_broken_pages(self):
+        page_bytes = (FIXTURES / 'flat_page_script_comment.html').read_bytes()
+        pages = {'/ok': (page_bytes, None), '/empty': (b'', None)}
+        self.parser.get_flat_page = pages.get
+        self.parser.get_plan_images = lambda url: None
+
+        flats = list(self.parser.iter_collect(set(pages)))
+
+        self.assertEqual([flat.number for flat in flats], ['101'])
+
+
+if __name__ == '__main__':
+    unittest.main()